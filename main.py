@@ -1,9 +1,13 @@
-import os, re, time, json, asyncio, base64
+import os, re, asyncio, base64, gzip, hashlib, tempfile, multiprocessing, uuid
 from pathlib import Path
 from datetime import datetime, timezone
 from collections import Counter
+from functools import lru_cache, partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
-import requests
+import httpx
+import orjson
 import pytesseract
 from pdf2image import convert_from_path
 from langdetect import detect, DetectorFactory
@@ -18,6 +22,7 @@ from telegram.ext import Application, CommandHandler, MessageHandler, ContextTyp
 
 
 DetectorFactory.seed = 0
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
 
 
 INBOX_DIR = Path(os.getenv("INBOX_DIR", "./inbox"))
@@ -27,9 +32,36 @@ TEXT_DIR.mkdir(parents=True, exist_ok=True)
 
 ALLOWED_EXT = {".pdf", ".docx", ".txt", ".md"}
 
+CPU_COUNT = os.cpu_count() or 4
+CPU_WORKERS = max(1, int(os.getenv("CPU_WORKERS") or CPU_COUNT // 2))
+OCR_THREADS = max(1, CPU_COUNT // CPU_WORKERS)
+
+_EMAIL_RE = re.compile(r"\b[\w\.-]+@[\w\.-]+\.\w+\b")
+_HANDLE_RE = re.compile(r"@[\w_]{3,}")
+_PHONE_RE = re.compile(r"\+?\d[\d\s\-\(\)]{7,}\d")
+_LABEL_RE = re.compile(r"\b(?:e-?mail|тел\.?|телефон)\b\s*[:\-]?\s*", re.I)
+_WS_RE = re.compile(r"\s+")
+_SENT_RE = re.compile(r"(?<=[.!?])\s+")
+_TOK_RE = re.compile(r"[A-Za-zА-Яа-яЁё]{3,}")
+_WORD_RE = re.compile(r"[A-Za-zА-Яа-яЁё]+")
+_LATIN_WORD_RE = re.compile(r"[a-z]+")
+
+_HF_CLIENT: httpx.AsyncClient | None = None
+HF_PERMANENT_ERRORS = {400, 401, 403, 404, 422}
+HF_BATCH_WINDOW = 0.1
+HF_BATCH_MAX_ITEMS = 8
+HF_BATCH_MAX_CHARS = 24000
+_hf_batches: dict[tuple[str, int, int], list[tuple[str, asyncio.Future]]] = {}
+_KW_EXTRACTORS: dict[tuple[str, int], yake.KeywordExtractor] = {}
+
+_pending_rows: list[tuple[list, asyncio.Future]] = []
+_pending_lock = asyncio.Lock()
+_flush_now = asyncio.Event()
+_background_tasks: set[asyncio.Task] = set()
+
 
 def detect_language(text: str) -> str:
-    t = re.sub(r"\s+", " ", (text or "")).strip()
+    t = _WS_RE.sub(" ", (text or "")).strip()
     if len(t) < 30:
         return "unknown"
     try:
@@ -64,116 +96,241 @@ def extract_text_native(path: Path) -> dict:
         return {"text": text, "meta": meta}
 
     if ext == ".pdf":
-        from pypdf import PdfReader
-        r = PdfReader(str(path))
-        chunks = [(p.extract_text() or "") for p in r.pages]
+        try:
+            import fitz
+            with fitz.open(str(path)) as doc:
+                chunks = [pg.get_text("text") for pg in doc]
+                pages = doc.page_count
+            method = "pymupdf"
+        except Exception:
+            from pypdf import PdfReader
+            r = PdfReader(str(path))
+            chunks = [(p.extract_text() or "") for p in r.pages]
+            pages = len(r.pages)
+            method = "pypdf"
         text = "\n".join(chunks)
-        meta.update(method="pypdf", pages=len(r.pages), chars=len(text))
+        meta.update(method=method, pages=pages, chars=len(text))
         return {"text": text, "meta": meta}
 
     return {"text": "", "meta": {"method": "unsupported", "pages": None, "chars": 0}}
 
 
-def ocr_pdf(path: Path, max_pages: int = 5, dpi: int = 200, lang: str = "rus+eng") -> dict:
-    images = convert_from_path(str(path), dpi=dpi, first_page=1, last_page=max_pages)
-    text = "\n".join(pytesseract.image_to_string(img, lang=lang) for img in images)
-    return {"text": text, "meta": {"method": "tesseract_ocr", "pages": len(images), "chars": len(text)}}
+def ocr_batch(paths: list[str], lang: str) -> str:
+    first = Path(paths[0])
+    list_path = first.with_name(f"{first.stem}.list.txt")
+    list_path.write_text("\n".join(paths) + "\n")
+    text = pytesseract.image_to_string(str(list_path), lang=lang, config="--oem 1")
+    return text.replace("\f", "\n")
+
+
+def ocr_pdf(path: Path, max_pages: int = 5, dpi: int = 200, lang: str = "rus+eng", stop_chars: int | None = None) -> dict:
+    workers = max(1, min(max_pages, OCR_THREADS))
+    texts, pages = [], 0
+    with tempfile.TemporaryDirectory() as tmp, ThreadPoolExecutor(max_workers=workers) as ex:
+        for first, last in ((1, 1), (2, max_pages)):
+            if first > last:
+                break
+            paths = convert_from_path(
+                str(path), dpi=dpi, first_page=first, last_page=last,
+                output_folder=tmp, paths_only=True, grayscale=True, thread_count=workers,
+            )
+            if not paths:
+                break
+            size = -(-len(paths) // workers)
+            batches = [paths[i:i + size] for i in range(0, len(paths), size)]
+            texts += ex.map(lambda b: ocr_batch(b, lang), batches)
+            pages += len(paths)
+            if stop_chars and sum(map(len, texts)) >= stop_chars:
+                break
+    text = "\n".join(texts)
+    return {"text": text, "meta": {"method": "tesseract_ocr", "pages": pages, "chars": len(text)}}
 
 
 def extract_text_with_ocr(path: Path, ocr_threshold_chars: int = 250, max_ocr_pages: int = 5) -> dict:
     native = extract_text_native(path)
     if path.suffix.lower() == ".pdf" and native["meta"]["chars"] < ocr_threshold_chars:
-        return ocr_pdf(path, max_pages=max_ocr_pages)
+        return ocr_pdf(path, max_pages=max_ocr_pages, stop_chars=ocr_threshold_chars * 4)
     return native
 
 
+def save_text(path: Path, text: str):
+    path.write_bytes(gzip.compress(text.encode("utf-8", errors="ignore"), compresslevel=1))
+
+
 def scrub_contacts(text: str) -> str:
     t = text or ""
-    t = re.sub(r"\b[\w\.-]+@[\w\.-]+\.\w+\b", " ", t)
-    t = re.sub(r"@[\w_]{3,}", " ", t)
-    t = re.sub(r"\+?\d[\d\s\-\(\)]{7,}\d", " ", t)
-    t = re.sub(r"\b(?:e-?mail|тел\.?|телефон)\b\s*[:\-]?\s*", " ", t, flags=re.I)
-    return re.sub(r"\s+", " ", t).strip()
+    t = _EMAIL_RE.sub(" ", t)
+    t = _HANDLE_RE.sub(" ", t)
+    t = _PHONE_RE.sub(" ", t)
+    t = _LABEL_RE.sub(" ", t)
+    return _WS_RE.sub(" ", t).strip()
 
 
 def simple_summary(text: str, max_chars: int = 900) -> str:
     t = scrub_contacts(text)
     if not t:
         return "—"
-    parts = re.split(r"(?<=[.!?])\s+", t)
+    parts = _SENT_RE.split(t)
     s = " ".join(parts[:3]).strip() if parts else t
     if len(s) > max_chars:
         s = s[:max_chars].rstrip() + "…"
     return s
 
 
-def hf_summarize(text: str, model: str = "facebook/bart-large-cnn", max_length: int = 160, min_length: int = 40) -> str:
-    token = os.getenv("HF_TOKEN", "").strip()
-    if not token:
-        return simple_summary(text)
+def hf_client() -> httpx.AsyncClient:
+    global _HF_CLIENT
+    if _HF_CLIENT is None:
+        _HF_CLIENT = httpx.AsyncClient(timeout=180, headers={"Content-Type": "application/json"})
+    return _HF_CLIENT
+
+
+def log_task_error(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        print(f"Background task failed: {task.exception()!r}")
+
+
+def run_in_background(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    task.add_done_callback(log_task_error)
+    return task
+
+
+def hf_summary_text(data) -> str:
+    if isinstance(data, list) and data and isinstance(data[0], dict) and "summary_text" in data[0]:
+        return data[0]["summary_text"].strip()
+    if isinstance(data, dict) and "summary_text" in data:
+        return str(data["summary_text"]).strip()
+    return str(data).strip()
 
+
+async def hf_request(token: str, model: str, inputs: list[str], max_length: int, min_length: int) -> list[str | None] | None:
     url = f"https://router.huggingface.co/hf-inference/models/{model}"
-    headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
-    payload = {
-        "inputs": (text or "")[:12000],
+    headers = {"Authorization": f"Bearer {token}"}
+    payload = orjson.dumps({
+        "inputs": inputs[0] if len(inputs) == 1 else inputs,
         "parameters": {"max_length": max_length, "min_length": min_length, "do_sample": False},
         "options": {"wait_for_model": True},
-    }
+    })
 
     for i in range(4):
-        r = requests.post(url, headers=headers, json=payload, timeout=180)
+        try:
+            r = await hf_client().post(url, headers=headers, content=payload)
+        except httpx.HTTPError as e:
+            print(f"HF request failed: {e!r}")
+            await asyncio.sleep(1.5 * (i + 1))
+            continue
         if r.status_code == 200:
-            data = r.json()
-            if isinstance(data, list) and data and isinstance(data[0], dict) and "summary_text" in data[0]:
-                return data[0]["summary_text"].strip()
-            if isinstance(data, dict) and "summary_text" in data:
-                return str(data["summary_text"]).strip()
-            return str(data).strip()
+            try:
+                data = orjson.loads(r.content)
+            except orjson.JSONDecodeError:
+                break
+            if len(inputs) == 1:
+                return [hf_summary_text(data)]
+            if isinstance(data, list) and len(data) == len(inputs):
+                return [hf_summary_text(d) for d in data]
+            return None
+
+        if r.status_code in HF_PERMANENT_ERRORS:
+            return None
 
         if r.status_code == 503:
             try:
-                j = r.json()
+                j = orjson.loads(r.content)
                 if isinstance(j, dict) and "estimated_time" in j:
-                    time.sleep(float(j["estimated_time"]) + 1.0)
+                    await asyncio.sleep(float(j["estimated_time"]) + 1.0)
                     continue
             except Exception:
                 pass
 
-        time.sleep(1.5 * (i + 1))
+        await asyncio.sleep(1.5 * (i + 1))
+
+    return [None] * len(inputs)
+
+
+async def hf_flush(token: str, key: tuple[str, int, int], batch: list[tuple[str, asyncio.Future]]):
+    await asyncio.sleep(HF_BATCH_WINDOW)
+    if _hf_batches.get(key) is batch:
+        del _hf_batches[key]
+    model, max_length, min_length = key
+    inputs = [t for t, _ in batch]
+    try:
+        results = await hf_request(token, model, inputs, max_length, min_length)
+        if results is None and len(inputs) > 1:
+            singles = await asyncio.gather(*(hf_request(token, model, [t], max_length, min_length) for t in inputs))
+            results = [r[0] if r else None for r in singles]
+    except Exception as e:
+        print(f"HF batch failed: {e!r}")
+        results = None
+    results = results or [None] * len(batch)
+    for (_, done), result in zip(batch, results):
+        if not done.done():
+            done.set_result(result)
+
+
+async def hf_summarize(text: str, model: str = "facebook/bart-large-cnn", max_length: int = 160, min_length: int = 40) -> str:
+    token = os.getenv("HF_TOKEN", "").strip()
+    if not token:
+        return simple_summary(text)
+
+    key = (model, max_length, min_length)
+    inputs = (text or "")[:12000]
+    done = asyncio.get_running_loop().create_future()
+    batch = _hf_batches.get(key)
+    if (
+        batch is None
+        or len(batch) >= HF_BATCH_MAX_ITEMS
+        or sum(len(t) for t, _ in batch) + len(inputs) > HF_BATCH_MAX_CHARS
+    ):
+        batch = _hf_batches[key] = []
+        run_in_background(hf_flush(token, key, batch))
+    batch.append((inputs, done))
 
-    return simple_summary(text)
+    summary = await done
+    return summary if summary is not None else simple_summary(text)
+
+
+@lru_cache(maxsize=50000)
+def zipf_en(w: str) -> float:
+    return zipf_frequency(w, "en")
+
+
+def keyword_extractor(lang: str, top: int) -> yake.KeywordExtractor:
+    key = (lang, top)
+    if key not in _KW_EXTRACTORS:
+        _KW_EXTRACTORS[key] = yake.KeywordExtractor(lan=lang, n=2, top=top)
+    return _KW_EXTRACTORS[key]
 
 
 def yake_keywords_clean(text: str, lang: str = "en", top_k: int = 8) -> list:
     lang = lang if lang in {"en", "ru", "de", "fr", "es", "it", "pt"} else "en"
-    clean = scrub_contacts(text)
+    clean = scrub_contacts(text)[:20000]
 
-    tokens = re.findall(r"[A-Za-zА-Яа-яЁё]{3,}", clean)
-    freq = Counter(t.lower() for t in tokens)
+    freq = Counter(_TOK_RE.findall(clean.lower()))
 
-    kw_extractor = yake.KeywordExtractor(lan=lang, n=2, top=top_k * 3)
-    kws = kw_extractor.extract_keywords(clean)
+    kws = keyword_extractor(lang, top_k * 3).extract_keywords(clean)
 
-    def is_gibberish_word(w: str) -> bool:
-        wl = w.lower()
+    def is_gibberish_word(wl: str) -> bool:
         if len(wl) < 4:
             return False
-        if re.fullmatch(r"[a-z]+", wl):
-            z = zipf_frequency(wl, "en")
+        if _LATIN_WORD_RE.fullmatch(wl):
+            z = zipf_en(wl)
             if z < 2.5 and freq.get(wl, 0) <= 1:
                 return True
         return False
 
     out = []
+    seen: set[str] = set()
     for kw, _ in kws:
         kw = " ".join(kw.split()).strip()
         if not kw:
             continue
-        words = re.findall(r"[A-Za-zА-Яа-яЁё]+", kw)
-        if any(is_gibberish_word(w) for w in words):
+        kl = kw.lower()
+        if kl in seen or any(is_gibberish_word(w) for w in _WORD_RE.findall(kl)):
             continue
-        if kw.lower() not in [x.lower() for x in out]:
-            out.append(kw)
+        seen.add(kl)
+        out.append(kw)
 
     out = out[:10]
     if len(out) < 5:
@@ -181,13 +338,45 @@ def yake_keywords_clean(text: str, lang: str = "en", top_k: int = 8) -> list:
     return out
 
 
-def summarize_and_keywords(text: str, lang_hint: str) -> dict:
-    clean = scrub_contacts(text)
+def new_cpu_pool() -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(max_workers=CPU_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+
+def run_marked(marker: str, fn, *args, **kwargs):
+    Path(marker).touch()
+    return fn(*args, **kwargs)
+
+
+async def run_cpu(bot_data: dict | None, fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    pool = bot_data.get("cpu_pool") if bot_data is not None else None
+    if pool is None:
+        return await loop.run_in_executor(None, partial(fn, *args, **kwargs))
+
+    marker = Path(tempfile.gettempdir()) / f"tg-kb-job-{uuid.uuid4().hex}"
+    call = partial(run_marked, str(marker), fn, *args, **kwargs)
+    try:
+        return await loop.run_in_executor(pool, call)
+    except BrokenProcessPool:
+        if bot_data.get("cpu_pool") is pool:
+            print("CPU pool broken, restarting")
+            bot_data["cpu_pool"] = new_cpu_pool()
+            pool.shutdown(wait=False, cancel_futures=True)
+        if marker.exists():
+            raise
+        return await loop.run_in_executor(bot_data["cpu_pool"], call)
+    finally:
+        marker.unlink(missing_ok=True)
+
+
+async def summarize_and_keywords(text: str, lang_hint: str, bot_data: dict | None = None) -> dict:
+    clean = await run_cpu(bot_data, scrub_contacts, text)
     if lang_hint == "en" and len(clean) >= 300:
-        summary = hf_summarize(clean)
+        summary_job = hf_summarize(clean)
     else:
-        summary = simple_summary(clean)
-    keywords = yake_keywords_clean(clean, lang=lang_hint, top_k=8)
+        summary_job = run_cpu(bot_data, simple_summary, clean)
+    keywords_job = run_cpu(bot_data, yake_keywords_clean, clean, lang=lang_hint, top_k=8)
+    summary, keywords = await asyncio.gather(summary_job, keywords_job)
     return {"summary": summary, "keywords": keywords}
 
 
@@ -227,13 +416,18 @@ def ensure_headers(ws):
         "local_path",
         "text_path",
     ]
+    cache_key = hashlib.sha1(f"{ws.spreadsheet.id}:{ws.id}:{','.join(headers)}".encode()).hexdigest()
+    cache_path = Path(f"/tmp/header_cache_{cache_key}")
+    if cache_path.exists():
+        return headers
     if ws.row_values(1) != headers:
         ws.clear()
         ws.append_row(headers)
+    cache_path.touch()
     return headers
 
 
-def append_record(ws, record: dict):
+async def append_record(record: dict):
     row = [
         record.get("timestamp"),
         record.get("uploader"),
@@ -251,7 +445,36 @@ def append_record(ws, record: dict):
         record.get("local_path"),
         record.get("text_path"),
     ]
-    ws.append_row(row, value_input_option="RAW")
+    done = asyncio.get_running_loop().create_future()
+    async with _pending_lock:
+        _pending_rows.append((row, done))
+    _flush_now.set()
+    await done
+
+
+async def flush_rows(ws):
+    async with _pending_lock:
+        batch = _pending_rows[:]
+        _pending_rows.clear()
+    if not batch:
+        return
+    try:
+        await asyncio.to_thread(ws.append_rows, [row for row, _ in batch], value_input_option="RAW")
+    except Exception as e:
+        for _, done in batch:
+            if not done.done():
+                done.set_exception(e)
+    else:
+        for _, done in batch:
+            if not done.done():
+                done.set_result(None)
+
+
+async def flush_loop(ws):
+    while True:
+        await _flush_now.wait()
+        _flush_now.clear()
+        await flush_rows(ws)
 
 
 def format_reply(record: dict, sheets_status: str) -> str:
@@ -317,12 +540,18 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     local_path = INBOX_DIR / f"{doc.file_unique_id}_{file_name}"
     await tg_file.download_to_drive(custom_path=str(local_path))
 
-    parsed = extract_text_with_ocr(local_path, ocr_threshold_chars=250, max_ocr_pages=5)
+    bot_data = context.application.bot_data
+    try:
+        parsed = await run_cpu(bot_data, extract_text_with_ocr, local_path, ocr_threshold_chars=250, max_ocr_pages=5)
+    except Exception as e:
+        print(f"Text extraction failed for {file_name}: {e!r}")
+        await msg.reply_text("❌ Не удалось обработать файл.")
+        return
     full_text = parsed["text"]
     meta = parsed["meta"]
 
-    text_path = TEXT_DIR / f"{doc.file_unique_id}.txt"
-    text_path.write_text(full_text, errors="ignore")
+    text_path = TEXT_DIR / f"{doc.file_unique_id}.txt.gz"
+    run_in_background(asyncio.to_thread(save_text, text_path, full_text))
 
     lang = detect_language(full_text[:4000])
     lang_hint = lang if lang in {"en", "ru"} else "en"
@@ -333,7 +562,12 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     note = (msg.caption or "").strip()
     uploader = f"@{msg.from_user.username}" if msg.from_user and msg.from_user.username else str(msg.from_user.id)
 
-    ai = await asyncio.to_thread(summarize_and_keywords, full_text, lang_hint)
+    try:
+        ai = await summarize_and_keywords(full_text, lang_hint, bot_data)
+    except Exception as e:
+        print(f"Summary/keywords failed for {file_name}: {e!r}")
+        await msg.reply_text("❌ Не удалось обработать файл.")
+        return
     summary = ai["summary"]
     keywords = ", ".join(ai["keywords"])
 
@@ -357,13 +591,35 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     sheets_status = "appended ✅"
     try:
-        ws = context.application.bot_data["ws"]
-        append_record(ws, record)
+        await append_record(record)
     except Exception:
         sheets_status = "failed ❌"
 
     await msg.reply_text(format_reply(record, sheets_status), parse_mode="Markdown")
-    print(json.dumps(record, ensure_ascii=False, indent=2))
+    print(orjson.dumps(record, option=orjson.OPT_INDENT_2).decode())
+
+
+async def on_startup(app: Application):
+    app.bot_data["cpu_pool"] = new_cpu_pool()
+    app.bot_data["flush_task"] = asyncio.create_task(flush_loop(app.bot_data["ws"]))
+
+
+async def on_shutdown(app: Application):
+    task = app.bot_data.get("flush_task")
+    if task is not None:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+    await flush_rows(app.bot_data["ws"])
+    if _background_tasks:
+        await asyncio.gather(*_background_tasks, return_exceptions=True)
+    pool = app.bot_data.get("cpu_pool")
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+    if _HF_CLIENT is not None:
+        await _HF_CLIENT.aclose()
 
 
 def main():
@@ -380,7 +636,14 @@ def main():
     ws = sh.sheet1
     ensure_headers(ws)
 
-    app = Application.builder().token(tg_token).build()
+    app = (
+        Application.builder()
+        .token(tg_token)
+        .concurrent_updates(True)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
     app.bot_data["ws"] = ws
 
     app.add_handler(CommandHandler("start", start_cmd))